@@ -1,28 +1,70 @@
 import argparse
+import atexit
+import json
 import math
 import os
 import platform
 import re
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 
 import librosa
+import numba
 import numpy as np
 import sounddevice as sd
+import soundfile as sf
+import soxr
+from threadpoolctl import threadpool_limits
 
 GREEN = "\033[92m"
 RED = "\033[91m"
 RESET = "\033[0m"
 
+# Note names in filenames ("Piano-A4.wav") and user input.
+_RE_NOTE_IN_NAME = re.compile(r"-([A-G][#b]?\d)\.wav$", re.IGNORECASE)
+_RE_NOTE_SUB = re.compile(r"-([A-G][#b]?\d)(\.wav)$", re.IGNORECASE)
+_RE_NOTE_VALID = re.compile(r"^[A-G][#b]?\d$")
+_RE_NOTE_LETTER = re.compile(r"([A-G])([#b]?)(\d+)", re.IGNORECASE)
+
+# Pitch class of each natural note; sharps and flats shift it by one.
+_PC_MAP = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+_ACCIDENTALS = {"": 0, "#": 1, "B": -1}
+
+_NOTE_NAMES = np.array(
+    ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+)
+
+# Filenames confirmed to match their detected note, keyed by absolute path.
+# Each entry records the file's mtime and size so edited or replaced files
+# are analyzed again.
+CACHE_FILE = ".note_detector_cache.json"
+
+# Pitch search range for detection, computed once rather than per file.
+_PYIN_FMIN = float(librosa.note_to_hz("C2"))
+_PYIN_FMAX = float(librosa.note_to_hz("C7"))
+
+# Audio is resampled to this rate before detection, which halves the samples
+# for typical 44.1/48 kHz files. Going lower leaves the top octave with
+# periods of under ~10 samples, and YIN/pyin start locking onto multiples.
+_ANALYSIS_SR = 22050
+
+# Longest stretch of audio, in seconds, that pitch detection looks at.
+_ANALYSIS_SECONDS = 2.0
+
 
 def play_wav(path):
+    # Starts playback and returns without waiting for it to finish. Returns
+    # the player process, or None when playing through sounddevice; pass the
+    # result to wait_playback or stop_playback.
     system = platform.system().lower()
     try:
         if system == "darwin":  # macOS
-            subprocess.run(["afplay", path])
+            return subprocess.Popen(["afplay", path])
         elif system == "windows":
             # Use PowerShell to play audio on Windows
-            subprocess.run(
+            return subprocess.Popen(
                 [
                     "powershell",
                     "-c",
@@ -33,98 +75,305 @@ def play_wav(path):
             # Try different Linux audio players
             for cmd in ["aplay", "paplay", "play"]:
                 try:
-                    subprocess.run([cmd, path], stderr=subprocess.DEVNULL)
-                    break
+                    return subprocess.Popen([cmd, path], stderr=subprocess.DEVNULL)
                 except FileNotFoundError:
                     continue
             else:
                 # If all commands fail, try using sounddevice as fallback
-                y, sr = librosa.load(path, sr=None)
+                y, sr = sf.read(path, dtype="float32")
                 sd.play(y, sr)
-                sd.wait()
         else:
             # Unknown OS, try using sounddevice as fallback
-            y, sr = librosa.load(path, sr=None)
+            y, sr = sf.read(path, dtype="float32")
             sd.play(y, sr)
-            sd.wait()
     except Exception as e:
         print(f"Error playing audio: {e}")
         # Try fallback to sounddevice if primary method fails
         try:
             y, sr = librosa.load(path, sr=None)
             sd.play(y, sr)
-            sd.wait()
         except Exception as e2:
             print(f"Fallback audio playback failed: {e2}")
+    return None
 
 
-def play_tone(freq, duration=2, sr=44100, amp=0.5):
-    t = np.linspace(0, duration, int(sr * duration), endpoint=False)
-    tone = amp * np.sin(2 * np.pi * freq * t)
-    sd.play(tone, sr)
-    sd.wait()
+def wait_playback(proc):
+    if proc is not None:
+        proc.wait()
+    else:
+        sd.wait()
 
 
-def freq_to_note_name(freq):
-    midi = int(round(69 + 12 * math.log2(freq / 440.0)))
-    notes = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    return notes[midi % 12] + str((midi // 12) - 1)
+def stop_playback(proc):
+    if proc is not None and proc.poll() is None:
+        proc.terminate()
+        proc.wait()
+    sd.stop()
 
 
-def note_letter(note):
-    m = re.match(r"([A-G][#b]?)(\d+)", note)
-    return m.group(1) if m else note
+@lru_cache(maxsize=128)
+def tone_buffer(freq, duration, sr, amp):
+    # The same expected/detected tones come up again and again during review.
+    t = np.arange(int(sr * duration), dtype=np.float32) / np.float32(sr)
+    return np.float32(amp) * np.sin(np.float32(2 * np.pi * freq) * t)
 
 
-def process_file(path, notes_only_flag, play_file=False, play_detected=False):
-    base = os.path.basename(path)
-    m = re.search(r"-([A-G][#b]?\d)\.wav$", base, re.IGNORECASE)
+def play_tone(freq, duration=2, sr=44100, amp=0.5, block=True):
+    sd.play(tone_buffer(round(float(freq), 2), duration, sr, amp), sr)
+    if block:
+        sd.wait()
+
+
+def freqs_to_note_names(freqs):
+    # Note name ("A4") of each frequency in an array of positive frequencies.
+    midi = np.rint(69 + 12 * np.log2(freqs / 440.0)).astype(np.int64)
+    return np.char.add(_NOTE_NAMES[midi % 12], (midi // 12 - 1).astype(str))
+
+
+def note_to_midi(note):
+    # "A4" -> 69. Expected notes are upper-cased, so "DB4" is read as Db4.
+    # Returns None for anything that is not a note name (e.g. "None").
+    m = _RE_NOTE_LETTER.match(note)
     if not m:
-        print(f"Skipping (no expected note): {path}")
+        return None
+    letter, accidental, octave = m.groups()
+    pc = _PC_MAP[letter.upper()] + _ACCIDENTALS[accidental.upper()]
+    return (int(octave) + 1) * 12 + pc
+
+
+def notes_match(a, b):
+    midi_a = note_to_midi(a) if a else None
+    return midi_a is not None and midi_a == note_to_midi(b)
+
+
+def expected_note(path):
+    m = _RE_NOTE_IN_NAME.search(os.path.basename(path))
+    return m.group(1).upper() if m else None
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache):
+    # Drop entries for files that were renamed, deleted or changed so the
+    # cache only holds what a later run can still use.
+    current = {
+        path: entry for path, entry in cache.items() if cached_note(cache, path)
+    }
+    try:
+        with open(CACHE_FILE, "w") as f:
+            json.dump(current, f)
+    except OSError as e:
+        print(RED + f"Could not save cache: {e}" + RESET)
+
+
+def cached_note(cache, path):
+    entry = cache.get(os.path.abspath(path))
+    if not isinstance(entry, dict):
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if entry.get("mtime_ns") != st.st_mtime_ns or entry.get("size") != st.st_size:
+        return None
+    return entry.get("note")
+
+
+def cache_note(cache, path, note):
+    st = os.stat(path)
+    cache[os.path.abspath(path)] = {
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "note": note,
+    }
+
+
+def remember_match(cache, future):
+    # Done-callback for analysis futures; runs in the executor's thread.
+    if future.cancelled() or future.exception() is not None:
         return
-    expected = m.group(1).upper()
-    print(f"Processing {path} (expected: {expected})")
+    path, expected, _, detected_note, error = future.result()
+    if error is None and notes_match(detected_note, expected):
+        try:
+            cache_note(cache, path, detected_note)
+        except OSError as e:
+            print(RED + f"Error caching result for {path}: {e}" + RESET)
 
-    if play_file:
-        print("Playing original audio file...")
-        play_wav(path)
 
+def stop_pool(ex):
+    # Drop queued analysis and stop the workers mid-file. Cancelling alone is
+    # not enough: at exit the executor still waits on tasks already handed to
+    # a worker, and on Python 3.11 that wait can hang outright.
+    if hasattr(ex, "terminate_workers"):  # Python 3.14+
+        ex.terminate_workers()
+        return
+    for proc in list((ex._processes or {}).values()):
+        proc.terminate()
+    ex.shutdown(wait=False, cancel_futures=True)
+
+
+def init_worker():
+    # Each worker already runs on its own core; keep BLAS/OpenMP from
+    # spawning extra threads per process and oversubscribing the machine.
+    threadpool_limits(1)
+    numba.set_num_threads(1)
+
+
+@numba.njit(cache=True, fastmath=True, parallel=True)
+def yin_f0(y, sr, fmin, fmax, frame_length=2048, hop=512, threshold=0.1):
+    # Plain frame-wise YIN: cumulative mean normalized difference, first dip
+    # below the threshold, parabolic interpolation. Unvoiced frames are 0.
+    # Samples only need one steady pitch, so pyin's HMM smoothing is skipped.
+    # Clips shorter than one frame are analyzed as a single frame; lags must
+    # still fit twice into it, so very short clips lose the lowest notes.
+    frame_length = min(frame_length, len(y))
+    tau_min = max(1, int(sr / fmax))
+    tau_max = min(frame_length // 2, int(math.ceil(sr / fmin)))
+    if tau_max <= tau_min + 1:
+        return np.zeros(0)
+    window = frame_length - tau_max
+    n_frames = 1 + (len(y) - frame_length) // hop
+    f0 = np.zeros(n_frames)
+    for i in numba.prange(n_frames):
+        start = i * hop
+        diffs = np.zeros(tau_max + 1)
+        cmnd = np.ones(tau_max + 1)
+        running = 0.0
+        for tau in range(1, tau_max + 1):
+            d = 0.0
+            for j in range(window):
+                diff = y[start + j] - y[start + j + tau]
+                d += diff * diff
+            diffs[tau] = d
+            running += d
+            if running > 0.0:
+                cmnd[tau] = d * tau / running
+        tau = tau_min
+        while tau < tau_max and cmnd[tau] >= threshold:
+            tau += 1
+        if tau >= tau_max:
+            continue
+        while tau + 1 < tau_max and cmnd[tau + 1] < cmnd[tau]:
+            tau += 1
+        shift = 0.0
+        a, b, c = diffs[tau - 1], diffs[tau], diffs[tau + 1]
+        denom = a - 2.0 * b + c
+        if denom != 0.0:
+            shift = min(1.0, max(-1.0, 0.5 * (a - c) / denom))
+        f0[i] = sr / (tau + shift)
+    return f0
+
+
+def analysis_window(y, sr):
+    # Drop leading/trailing silence, then keep at most _ANALYSIS_SECONDS
+    # centered on the loudest frame. Long decays add frames, not information.
+    y, _ = librosa.effects.trim(y, top_db=30)
+    length = int(sr * _ANALYSIS_SECONDS)
+    if len(y) <= length:
+        return y
+    hop = 512
+    rms = librosa.feature.rms(y=y, frame_length=2048, hop_length=hop)[0]
+    peak = int(np.argmax(rms)) * hop
+    start = min(max(0, peak - length // 2), len(y) - length)
+    return y[start : start + length]
+
+
+def analyze_file(path, accurate=False):
+    # Runs in a worker process: no printing or user interaction here.
+    # Returns (path, expected, detected_freq, detected_note, error).
+    expected = expected_note(path)
     try:
-        y, sr = librosa.load(path, sr=None)
-        f0, _, _ = librosa.pyin(
-            y,
-            fmin=float(librosa.note_to_hz("C2")),
-            fmax=float(librosa.note_to_hz("C7")),
-        )
+        # Candidates are always WAV, so read them directly with soundfile
+        # instead of going through librosa.load's audioread machinery.
+        y, sr = sf.read(path, dtype="float32", always_2d=False)
+        if y.ndim == 2:
+            y = y.mean(axis=1)
+        # Low-rate files are upsampled too: the lag resolution matters more
+        # for YIN/pyin than the missing bandwidth.
+        if sr != _ANALYSIS_SR:
+            y = soxr.resample(y, sr, _ANALYSIS_SR)
+            sr = _ANALYSIS_SR
+        y = analysis_window(y, sr)
+        if accurate:
+            f0, _, _ = librosa.pyin(
+                y,
+                sr=sr,
+                fmin=_PYIN_FMIN,
+                fmax=_PYIN_FMAX,
+            )
+        else:
+            f0 = yin_f0(y, sr, _PYIN_FMIN, _PYIN_FMAX)
+            f0[f0 <= 0] = np.nan
     except Exception as e:
-        print(RED + f"Error processing {path}: {e}" + RESET)
-        return
-    valid = f0[~np.isnan(f0)]
-    if len(valid) == 0:
+        return path, expected, 0, "None", str(e)
+    unvoiced = np.isnan(f0)
+    if unvoiced.all():
         detected_freq = 0
         detected_note = "None"
     else:
-        detected_freq = np.median(valid)
-        try:
-            detected_note = freq_to_note_name(detected_freq)
-        except Exception:
-            detected_note = "Error"
+        detected_freq = float(np.nanmedian(f0))
+        # Take the most common per-frame note rather than the note of the
+        # median frequency; vibrato or a drifting tail cannot pull it over a
+        # semitone boundary.
+        names = freqs_to_note_names(f0[~unvoiced])
+        notes, counts = np.unique(names, return_counts=True)
+        detected_note = str(notes[np.argmax(counts)])
+    return path, expected, detected_freq, detected_note, None
+
+
+def rename_file(path, new_base, color, label):
+    # Rename within the same directory and report the outcome.
+    new_path = os.path.join(os.path.dirname(path), new_base)
+    try:
+        os.rename(path, new_path)
+        print(color + f"{label}: {new_path}" + RESET)
+    except Exception as e:
+        print(RED + f"Error renaming file: {e}" + RESET)
+
+
+def process_file(result, notes_only_flag, play_file=False, play_detected=False):
+    path, expected, detected_freq, detected_note, error = result
+    base = os.path.basename(path)
+    print(f"Processing {path} (expected: {expected})")
+
+    # The preview keeps playing while the result is shown, and through the
+    # review prompt for mismatches.
+    preview = None
+    if play_file:
+        print("Playing original audio file...")
+        preview = play_wav(path)
+
+    if error is not None:
+        print(RED + f"Error processing {path}: {error}" + RESET)
+        wait_playback(preview)
+        return
 
     # Play the detected note if requested
     if play_detected and detected_freq > 0:
+        wait_playback(preview)
         print(f"Playing detected note {detected_note} at {detected_freq:.2f}Hz...")
         play_tone(detected_freq, duration=1)
 
-    # Determine if mismatch is solely an octave difference.
+    # Compare as MIDI numbers: an octave-only mismatch is a nonzero multiple
+    # of 12 semitones, and enharmonic spellings (C#4/Db4) count as a match.
+    midi_detected = note_to_midi(detected_note)
+    midi_expected = note_to_midi(expected)
     octave_only = False
-    if detected_note.upper() != expected.upper():
-        if note_letter(detected_note) == note_letter(expected):
-            octave_only = True
+    if midi_detected is not None and midi_expected is not None:
+        diff = midi_detected - midi_expected
+        octave_only = diff != 0 and diff % 12 == 0
 
-    if detected_note.upper() == expected.upper():
+    if notes_match(detected_note, expected):
         print(
             GREEN + f"Match: {base} -> {detected_note} at {detected_freq:.2f}Hz" + RESET
         )
+        wait_playback(preview)
         return
     elif octave_only and notes_only_flag:
         # If --notes-only is set and the mismatch is only an octave difference, skip review.
@@ -133,6 +382,7 @@ def process_file(path, notes_only_flag, play_file=False, play_detected=False):
             + f"Octave-only mismatch (skipped review): {base} (expected {expected}, detected {detected_note})"
             + RESET
         )
+        wait_playback(preview)
         return
     elif octave_only:
         print(
@@ -148,9 +398,10 @@ def process_file(path, notes_only_flag, play_file=False, play_detected=False):
         )
 
     input("Press spacebar (then Enter) to review mismatch...")
+    stop_playback(preview)
 
     print("Playing original WAV file...")
-    play_wav(path)
+    wait_playback(play_wav(path))
     try:
         expected_freq = librosa.note_to_hz(expected)
         print(
@@ -160,12 +411,13 @@ def process_file(path, notes_only_flag, play_file=False, play_detected=False):
     except Exception as e:
         print("Could not play expected tone:", e)
     print("Replaying original WAV file...")
-    play_wav(path)
+    wait_playback(play_wav(path))
     if detected_freq > 0:
         print(
             f"Playing 2-second tone at detected frequency {detected_freq:.2f} Hz (detected note: {detected_note})..."
         )
-        play_tone(detected_freq, duration=2)
+        # Left playing so the user can choose without waiting for it.
+        play_tone(detected_freq, duration=2, block=False)
     else:
         print("No valid detected frequency; skipping tone playback.")
 
@@ -176,48 +428,25 @@ def process_file(path, notes_only_flag, play_file=False, play_detected=False):
 
     while True:
         choice = input("Choose action " + options).strip().lower()
+        sd.stop()
         if choice == "k":
             print("Keeping filename as-is.")
             break
         elif choice == "r":
-            new_note = detected_note
-            new_base = re.sub(
-                r"-([A-G][#b]?\d)(\.wav)$", f"-{new_note}\\2", base, flags=re.IGNORECASE
-            )
-            new_path = os.path.join(os.path.dirname(path), new_base)
-            try:
-                os.rename(path, new_path)
-                print(GREEN + f"Renamed file to: {new_path}" + RESET)
-            except Exception as e:
-                print(RED + f"Error renaming file: {e}" + RESET)
+            new_base = _RE_NOTE_SUB.sub(f"-{detected_note}\\2", base)
+            rename_file(path, new_base, GREEN, "Renamed file to")
             break
         elif choice == "m":
             manual_note = input("Enter correct note (e.g., A4): ").strip().upper()
-            if re.match(r"^[A-G][#b]?\d$", manual_note):
-                new_base = re.sub(
-                    r"-([A-G][#b]?\d)(\.wav)$",
-                    f"-{manual_note}\\2",
-                    base,
-                    flags=re.IGNORECASE,
-                )
-                new_path = os.path.join(os.path.dirname(path), new_base)
-                try:
-                    os.rename(path, new_path)
-                    print(GREEN + f"Renamed file to: {new_path}" + RESET)
-                except Exception as e:
-                    print(RED + f"Error renaming file: {e}" + RESET)
+            if _RE_NOTE_VALID.match(manual_note):
+                new_base = _RE_NOTE_SUB.sub(f"-{manual_note}\\2", base)
+                rename_file(path, new_base, GREEN, "Renamed file to")
                 break
             else:
                 print("Invalid note format. Try again.")
         elif choice == "f" and not octave_only:
             if not base.startswith("_"):
-                new_base = "_" + base
-                new_path = os.path.join(os.path.dirname(path), new_base)
-                try:
-                    os.rename(path, new_path)
-                    print(RED + f"Flagged file for review: {new_path}" + RESET)
-                except Exception as e:
-                    print(RED + f"Error renaming file: {e}" + RESET)
+                rename_file(path, "_" + base, RED, "Flagged file for review")
             else:
                 print("File is already flagged for review.")
             break
@@ -225,6 +454,22 @@ def process_file(path, notes_only_flag, play_file=False, play_detected=False):
             print("Invalid choice. Please enter one of the offered options.")
 
 
+def iter_wavs(root):
+    # Recursive os.scandir walk; DirEntry type checks avoid extra stat calls.
+    # Unreadable directories are skipped, as os.walk would.
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from iter_wavs(entry.path)
+                elif entry.is_file():
+                    name = entry.name.lower()
+                    if name.endswith(".wav") and "fx" not in name:
+                        yield entry.path
+    except OSError:
+        return
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Review WAV files for pitch mismatches."
@@ -240,7 +485,12 @@ def main():
     parser.add_argument(
         "--play-file",
         action="store_true",
-        help="Play the original audio file before analysis",
+        help="Play the original audio file before showing its result",
+    )
+    parser.add_argument(
+        "--accurate",
+        action="store_true",
+        help="Use librosa's pyin for pitch detection (slower, HMM-smoothed)",
     )
     parser.add_argument("paths", nargs="+", help="Files or directories to process")
     args = parser.parse_args()
@@ -252,27 +502,71 @@ def main():
         if os.path.isdir(path):
             # If path is a directory, find all .wav files in it
             print(f"Scanning directory: {path}")
-            for root, _, files in os.walk(path):
-                for file in files:
-                    if file.lower().endswith(".wav") and "fx" not in file.lower():
-                        candidate_files.append(os.path.join(root, file))
+            candidate_files.extend(iter_wavs(path))
         elif os.path.isfile(path) and path.lower().endswith(".wav"):
             # If path is a .wav file, add it directly
             candidate_files.append(path)
         else:
             print(f"Skipping {path}: Not a valid directory or .wav file")
 
+    cache = load_cache()
+    atexit.register(save_cache, cache)
+
+    # Files without an expected note in their name have nothing to check, and
+    # files that matched on a previous run are skipped while unchanged.
+    analyzable = []
+    for path in candidate_files:
+        expected = expected_note(path)
+        if expected is None:
+            print(f"Skipping (no expected note): {path}")
+        elif notes_match(cached_note(cache, path), expected):
+            print(
+                GREEN
+                + f"Match (cached): {os.path.basename(path)} -> {expected}"
+                + RESET
+            )
+        else:
+            analyzable.append(path)
+    candidate_files = analyzable
+
     total = len(candidate_files)
     if total == 0:
-        print("No candidate WAV files found.")
+        print("No candidate WAV files need analysis.")
         return
     print(f"Found {total} candidate files.")
-    count = 0
-    for path in candidate_files:
-        count += 1
-        percent = (count / total) * 100
-        print(f"\nProcessing file {count} of {total} ({percent:.1f}% complete)")
-        process_file(path, args.notes_only, args.play_file, args.play)
+
+    # Pitch detection is CPU-bound and independent per file, so analyze
+    # across all cores. Review stays on the main process since it plays audio
+    # and prompts for input, and starts as soon as the first file is done
+    # while the pool keeps working through the rest.
+    workers = os.cpu_count() or 1
+    print(f"Analyzing with {workers} worker processes...")
+    ex = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+    try:
+        futures = [
+            ex.submit(analyze_file, path, args.accurate) for path in candidate_files
+        ]
+        # Record matches as they complete, not when review reaches them, so
+        # quitting during an earlier mismatch does not lose the later ones.
+        for future in futures:
+            future.add_done_callback(partial(remember_match, cache))
+
+        for count, (path, future) in enumerate(zip(candidate_files, futures), 1):
+            percent = (count / total) * 100
+            print(f"\nProcessing file {count} of {total} ({percent:.1f}% complete)")
+            try:
+                result = future.result()
+            except Exception as e:
+                # e.g. BrokenProcessPool after a worker crash: report it per
+                # file like an analysis error and keep reviewing.
+                result = path, expected_note(path), 0, "None", str(e)
+            process_file(result, args.notes_only, args.play_file, args.play)
+    except BaseException:
+        # Quitting mid-review (EOF, Ctrl-C) must not wait for the rest of the
+        # batch to be analyzed.
+        stop_pool(ex)
+        raise
+    ex.shutdown()
 
 
 if __name__ == "__main__":